@@ -1,16 +1,36 @@
 import os
+import threading
 import time
+from collections import OrderedDict
+from functools import lru_cache
 from io import BytesIO
-from typing import Tuple
+from typing import List, Optional, Tuple
+from urllib.parse import quote
 
+import orjson
 import requests
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import JSONProvider
 from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # -------- Version (so you can confirm Render is running this exact file) --------
 VERSION = "maptiler-full-1"
 
+
+class _OrjsonProvider(JSONProvider):
+    """jsonify / request.get_json backed by orjson (Rust) instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = _OrjsonProvider(app)
 
 # -------- Config / Env --------
 USER_AGENT = os.environ.get("USER_AGENT", "map-poster-service/1.0 (contact: you@domain.com)")
@@ -22,21 +42,132 @@ DEFAULT_ZOOM = int(os.environ.get("DEFAULT_ZOOM", "12"))      # 0..20 typical
 DEFAULT_SIZE = int(os.environ.get("DEFAULT_SIZE", "1024"))    # output map square px (512..4096)
 DEFAULT_THEME = os.environ.get("DEFAULT_THEME", "neon")       # neon | dark | light
 
+# zlib level for the output PNG: 1 = fastest encode / bigger file, 9 = slowest / smallest
+PNG_COMPRESS_LEVEL = max(0, min(int(os.environ.get("PNG_COMPRESS_LEVEL", "1")), 9))
+
 FONT_PATH = os.environ.get("FONT_PATH", "")  # optional: put a .ttf into repo and set env
 
+# memory budget (MB) for raw MapTiler responses kept per instance (@2x PNGs, up to several MB each); 0 disables
+MAP_CACHE_MB = max(0, int(os.environ.get("MAP_CACHE_MB", "32")))
+
+# output=jpeg: libjpeg(-turbo) encodes several times faster than PNG for map imagery, at a small quality cost
+JPEG_QUALITY = max(1, min(int(os.environ.get("JPEG_QUALITY", "92")), 95))
+
+# memory budget (MB) for finished posters kept per instance; 0 disables
+RENDER_CACHE_MB = max(0, int(os.environ.get("RENDER_CACHE_MB", "32")))
+
+
+# -------- HTTP --------
+# one pooled session per process: keep-alive to Nominatim / MapTiler instead of a TLS handshake per call.
+# MapTiler: retry transient failures (raise_on_status=False -> after the last retry callers still get
+# the response and raise_for_status()).
+# Nominatim: no automatic retries at all -- any urllib3 retry (429, 5xx, connect/read) would fire
+# 0-0.4 s after the throttled call and bypass _throttle_nominatim's 1 s spacing, typically while the
+# server is overloaded. Failures surface as errors instead. Longest mount prefix wins.
+def _http_adapter(max_retries) -> HTTPAdapter:
+    return HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=max_retries)
+
+
+_HTTP = requests.Session()
+_HTTP.headers["User-Agent"] = USER_AGENT
+_HTTP.mount(
+    "https://",
+    _http_adapter(
+        Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+    ),
+)
+_HTTP.mount("https://nominatim.openstreetmap.org/", _http_adapter(0))
+
 
 # -------- Helpers --------
+class _BytesLRU:
+    """Thread-safe LRU of bytes values, bounded by their total size instead of the entry count."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+
+# attribution (as you requested)
+_ATTRIBUTION = "© OpenStreetMap contributors • MapTiler"
+
+_DEFAULT_FONT = ImageFont.load_default()
+
+
+# fonts are immutable once loaded -> parse each (path, size) only once per process
+@lru_cache(maxsize=32)
 def _load_font(size: int) -> ImageFont.ImageFont:
     if FONT_PATH and os.path.exists(FONT_PATH):
         return ImageFont.truetype(FONT_PATH, size=size)
-    return ImageFont.load_default()
+    return _DEFAULT_FONT
 
 
-def geocode_nominatim(address: str) -> Tuple[float, float]:
-    r = requests.get(
+# the attribution line is the same on every poster: rasterize it once per (font, color) as an RGBA
+# tile (color + coverage alpha) and paste it afterwards. Title/subtitle are user text -> drawn directly.
+@lru_cache(maxsize=8)
+def _attribution_layer(font: ImageFont.ImageFont, fill: Tuple[int, int, int]) -> Tuple[Image.Image, int, int]:
+    left, top, right, bottom = font.getbbox(_ATTRIBUTION)
+    ox, oy = min(0, left), min(0, top)
+    layer = Image.new("RGBA", (max(1, right - ox), max(1, bottom - oy)), fill + (0,))
+    ImageDraw.Draw(layer).text((-ox, -oy), _ATTRIBUTION, font=font, fill=fill + (255,))
+    return layer, ox, oy
+
+
+# Nominatim usage policy: max 1 request/s. Only actual network calls are throttled (cache hits are free).
+_NOMINATIM_INTERVAL = 1.0
+_last_nominatim = 0.0
+_nominatim_lock = threading.Lock()
+
+
+def _throttle_nominatim() -> None:
+    global _last_nominatim
+    # serialized so concurrent requests queue up 1 s apart instead of all seeing the same timestamp
+    with _nominatim_lock:
+        wait = _NOMINATIM_INTERVAL - (time.monotonic() - _last_nominatim)
+        if wait > 0:
+            time.sleep(wait)
+        _last_nominatim = time.monotonic()
+
+
+def _cache_day() -> int:
+    # part of every provider-response cache key -> entries go stale after a day (well inside the ToS limits)
+    return int(time.time() // 86400)
+
+
+# addresses resolve to the same point every time -> don't re-ask Nominatim for repeats
+@lru_cache(maxsize=1024)
+def _geocode_cached(address: str, day: int) -> Tuple[float, float]:
+    _throttle_nominatim()
+    r = _HTTP.get(
         "https://nominatim.openstreetmap.org/search",
         params={"q": address, "format": "json", "limit": 1},
-        headers={"User-Agent": USER_AGENT},
         timeout=20,
     )
     r.raise_for_status()
@@ -46,6 +177,34 @@ def geocode_nominatim(address: str) -> Tuple[float, float]:
     return float(data[0]["lat"]), float(data[0]["lon"])
 
 
+def geocode_nominatim(address: str) -> Tuple[float, float]:
+    return _geocode_cached(address, _cache_day())
+
+
+# fixed query string, encoded once instead of urlencoding a params dict on every fetch
+_MAPTILER_QUERY = f"key={quote(MAPTILER_KEY, safe='')}&attribution=false"
+
+
+# raw MapTiler PNG per (rounded) center / zoom / size -> re-renders with new titles skip the download
+_MAP_CACHE = _BytesLRU(MAP_CACHE_MB * 1024 * 1024)
+
+
+def _fetch_maptiler_png(lat: float, lon: float, zoom: int, w: int, h: int, day: int) -> bytes:
+    key = (lat, lon, zoom, w, h, day)
+    png = _MAP_CACHE.get(key)
+    if png is not None:
+        return png
+
+    url = (
+        f"https://api.maptiler.com/maps/{MAPTILER_MAP_ID}/static/{lon:.6f},{lat:.6f},{zoom}/{w}x{h}@2x.png"
+        f"?{_MAPTILER_QUERY}"
+    )
+    r = _HTTP.get(url, timeout=30)
+    r.raise_for_status()
+    _MAP_CACHE.put(key, r.content)
+    return r.content
+
+
 def fetch_map_maptiler(lat: float, lon: float, zoom: int, size_px: int) -> Image.Image:
     if not MAPTILER_KEY:
         raise ValueError("Missing MAPTILER_KEY (set it in Render Environment Variables)")
@@ -59,43 +218,48 @@ def fetch_map_maptiler(lat: float, lon: float, zoom: int, size_px: int) -> Image
     w = max(256, min(size_px, 2048))
     h = max(256, min(size_px, 2048))
 
-    url = f"https://api.maptiler.com/maps/{MAPTILER_MAP_ID}/static/{lon},{lat},{zoom}/{w}x{h}@2x.png"
-    r = requests.get(
-        url,
-        params={"key": MAPTILER_KEY, "attribution": "false"},
-        headers={"User-Agent": USER_AGENT},
-        timeout=30,
-    )
-    r.raise_for_status()
-
-    img = Image.open(BytesIO(r.content)).convert("RGBA")
-    img = img.resize((size_px, size_px), Image.LANCZOS)
+    # 6 decimals ~ 0.1 m: folds near-duplicate coordinates onto one cache entry
+    png = _fetch_maptiler_png(round(lat, 6), round(lon, 6), zoom, w, h, _cache_day())
+
+    img = Image.open(BytesIO(png))
+    # JPEG can decode straight at a reduced scale; no-op for PNG
+    img.draft("RGB", (size_px, size_px))
+    # static maps are opaque: RGB from here on -> 3 bytes/px through reduce, theme and paste instead of 4
+    img = img.convert("RGB")
+    # integer part of the downscale as a cheap box reduce (the usual @2x -> 1x is exactly 2) ...
+    factor = img.width // size_px
+    if factor >= 2:
+        img = img.reduce(factor)
+    # ... and LANCZOS only for what's left (4096 px posters: the @2x response is already the right size)
+    if img.size != (size_px, size_px):
+        img = img.resize((size_px, size_px), Image.LANCZOS)
     return img
 
 
+def _theme_lut(alpha: int, g: float = 1.0, b: float = 1.0) -> List[int]:
+    # uniform black overlay of alpha A over the (opaque) map == x * (255 - A) / 255 per channel,
+    # followed by the per-channel tint -> one 256-entry table per band (R, G, B) for Image.point
+    dark = [round(x * (255 - alpha) / 255) for x in range(256)]
+    return dark + [min(255, int(v * g)) for v in dark] + [min(255, int(v * b)) for v in dark]
+
+
+_THEME_LUT = {
+    "dark": _theme_lut(140),
+    "neon": _theme_lut(165, g=0.95, b=1.10),  # subtle neon-ish push
+}
+
+
 def apply_theme(map_img: Image.Image, theme: str) -> Image.Image:
     theme = (theme or "").lower().strip()
     if theme not in ("neon", "dark", "light"):
         theme = DEFAULT_THEME
 
-    img = map_img.copy()
-
+    # light = untouched map; it's freshly decoded per request and never reused, so no defensive copy
     if theme == "light":
-        return img
+        return map_img
 
-    # darken overlay
-    alpha = 140 if theme == "dark" else 165
-    overlay = Image.new("RGBA", img.size, (0, 0, 0, alpha))
-    img = Image.alpha_composite(img, overlay)
-
-    if theme == "neon":
-        r, g, b, a = img.split()
-        # subtle neon-ish push
-        g = g.point(lambda x: min(255, int(x * 0.95)))
-        b = b.point(lambda x: min(255, int(x * 1.10)))
-        img = Image.merge("RGBA", (r, g, b, a))
-
-    return img
+    # a single table lookup pass in C: no overlay image, no split/merge, no temporaries
+    return map_img.point(_THEME_LUT.get(theme, _THEME_LUT["neon"]))  # bad DEFAULT_THEME env -> neon
 
 
 def compose_poster(
@@ -114,23 +278,23 @@ def compose_poster(
         theme = DEFAULT_THEME
 
     if theme == "light":
-        band_color = (250, 250, 250, 255)
-        text_color = (20, 20, 20, 255)
-        sub_color = (80, 80, 80, 255)
+        band_color = (250, 250, 250)
+        text_color = (20, 20, 20)
+        sub_color = (80, 80, 80)
     else:
-        band_color = (8, 8, 10, 255)
-        text_color = (235, 235, 240, 255)
-        sub_color = (170, 170, 180, 255)
+        band_color = (8, 8, 10)
+        text_color = (235, 235, 240)
+        sub_color = (170, 170, 180)
 
-    canvas = Image.new("RGBA", (size_px, size_px + band_h), band_color)
-    canvas.paste(map_img, (0, 0), map_img)
+    # Image.new already fills the band; the themed map is RGB too, so the paste is a straight row copy
+    canvas = Image.new("RGB", (size_px, size_px + band_h), band_color)
+    canvas.paste(map_img, (0, 0))
 
     draw = ImageDraw.Draw(canvas)
-    draw.rectangle([0, size_px, size_px, size_px + band_h], fill=band_color)
 
-    # text
-    title = (title or "").strip() or "YOUR PLACE"
-    subtitle = (subtitle or "").strip()
+    # text (upper-cased once here, drawn as-is below)
+    title = ((title or "").strip() or "YOUR PLACE").upper()
+    subtitle = (subtitle or "").strip().upper()
 
     x_pad = int(size_px * 0.06)
     y0 = size_px + int(band_h * 0.16)
@@ -140,23 +304,26 @@ def compose_poster(
     meta_font = _load_font(int(band_h * 0.16))
     attrib_font = _load_font(int(band_h * 0.13))
 
-    draw.text((x_pad, y0), title.upper(), font=title_font, fill=text_color)
+    draw.text((x_pad, y0), title, font=title_font, fill=text_color)
 
     y = y0 + int(band_h * 0.42)
     if subtitle:
-        draw.text((x_pad, y), subtitle.upper(), font=sub_font, fill=sub_color)
+        draw.text((x_pad, y), subtitle, font=sub_font, fill=sub_color)
 
     coords = f"{lat:.5f}, {lon:.5f}"
     draw.text((x_pad, size_px + band_h - int(band_h * 0.30)), coords, font=meta_font, fill=sub_color)
 
-    # attribution (as you requested)
-    attrib = "© OpenStreetMap contributors • MapTiler"
-    draw.text((x_pad, size_px + band_h - int(band_h * 0.14)), attrib, font=attrib_font, fill=sub_color)
+    layer, ox, oy = _attribution_layer(attrib_font, sub_color)
+    canvas.paste(layer, (x_pad + ox, size_px + band_h - int(band_h * 0.14) + oy), layer)
+
+    return canvas
 
-    return canvas.convert("RGB")
 
+_OUTPUT_MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg"}
+_OUTPUT_EXTENSIONS = {"png": "png", "jpeg": "jpg"}
 
-def parse_payload(payload: dict) -> Tuple[float, float, int, int, str, str, str]:
+
+def parse_payload(payload: dict) -> Tuple[float, float, int, int, str, str, str, str]:
     address = payload.get("address")
     lat = payload.get("lat")
     lon = payload.get("lon") if payload.get("lon") is not None else payload.get("lng")
@@ -166,14 +333,13 @@ def parse_payload(payload: dict) -> Tuple[float, float, int, int, str, str, str]
     theme = payload.get("theme", DEFAULT_THEME)
     title = payload.get("title", "")
     subtitle = payload.get("subtitle", "")
+    output = str(payload.get("output", "png")).lower().strip()
 
     if lat is not None and lon is not None:
         lat = float(lat)
         lon = float(lon)
     elif address:
         lat, lon = geocode_nominatim(str(address))
-        # be polite to Nominatim (avoid bursts)
-        time.sleep(1.0)
     else:
         raise ValueError("Provide either address OR (lat + lon/lng)")
 
@@ -183,7 +349,57 @@ def parse_payload(payload: dict) -> Tuple[float, float, int, int, str, str, str]
     zoom = max(0, min(zoom, 20))
     size_px = max(512, min(size_px, 4096))
 
-    return lat, lon, zoom, size_px, str(theme), str(title), str(subtitle)
+    if output == "jpg":
+        output = "jpeg"
+    if output not in _OUTPUT_MIMETYPES:
+        output = "png"
+
+    return lat, lon, zoom, size_px, str(theme), str(title), str(subtitle), output
+
+
+def _render_poster_uncached(
+    lat: float,
+    lon: float,
+    zoom: int,
+    size_px: int,
+    theme: str,
+    title: str,
+    subtitle: str,
+    output: str = "png",
+) -> bytes:
+    map_img = fetch_map_maptiler(lat=lat, lon=lon, zoom=zoom, size_px=size_px)
+    map_img = apply_theme(map_img, theme)
+    poster = compose_poster(map_img, title, subtitle, lat, lon, theme)
+
+    out = BytesIO()
+    if output == "jpeg":
+        poster.save(out, format="JPEG", quality=JPEG_QUALITY)
+    else:
+        poster.save(out, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return out.getvalue()
+
+
+# identical (normalized) requests -> same poster; retries / refreshes skip fetch + render + encode
+_RENDER_CACHE = _BytesLRU(RENDER_CACHE_MB * 1024 * 1024)
+
+
+def render_poster(
+    lat: float,
+    lon: float,
+    zoom: int,
+    size_px: int,
+    theme: str,
+    title: str,
+    subtitle: str,
+    output: str = "png",
+) -> bytes:
+    # the poster embeds provider map pixels -> same daily expiry as the raw map / geocode caches
+    key = (lat, lon, zoom, size_px, theme, title, subtitle, output, _cache_day())
+    data = _RENDER_CACHE.get(key)
+    if data is None:
+        data = _render_poster_uncached(lat, lon, zoom, size_px, theme, title, subtitle, output)
+        _RENDER_CACHE.put(key, data)
+    return data
 
 
 # -------- Routes --------
@@ -195,22 +411,16 @@ def health():
 def render():
     payload = request.get_json(silent=True) or {}
     try:
-        lat, lon, zoom, size_px, theme, title, subtitle = parse_payload(payload)
-
-        map_img = fetch_map_maptiler(lat=lat, lon=lon, zoom=zoom, size_px=size_px)
-        map_img = apply_theme(map_img, theme)
-        poster = compose_poster(map_img, title, subtitle, lat, lon, theme)
+        lat, lon, zoom, size_px, theme, title, subtitle, output = parse_payload(payload)
 
-        out = BytesIO()
-        poster.save(out, format="PNG", optimize=True)
-        out.seek(0)
+        data = render_poster(lat, lon, zoom, size_px, theme, title, subtitle, output)
 
         safe_name = (title.strip() or "poster").replace(" ", "_")[:40]
         return send_file(
-            out,
-            mimetype="image/png",
+            BytesIO(data),
+            mimetype=_OUTPUT_MIMETYPES[output],
             as_attachment=True,
-            download_name=f"{safe_name}.png",
+            download_name=f"{safe_name}.{_OUTPUT_EXTENSIONS[output]}",
         )
 
     except requests.HTTPError as e: